@@ -1,11 +1,13 @@
 from __future__ import annotations
 
+import asyncio
 import os
 from datetime import datetime, timedelta, timezone
-from typing import Optional
+from typing import Dict, List, Optional, Tuple
 
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from apscheduler.triggers.cron import CronTrigger
+from apscheduler.triggers.interval import IntervalTrigger
 from dotenv import load_dotenv
 from telegram import Update, Bot
 from telegram.ext import (
@@ -25,6 +27,11 @@ load_dotenv(override=False)
 
 TELEGRAM_BOT_TOKEN = os.environ.get("TELEGRAM_BOT_TOKEN", "")
 SUMMARY_RETENTION_DAYS = int(os.environ.get("SUMMARY_RETENTION_DAYS", "14"))
+SUMMARY_HOUR_UTC = 21
+SUMMARY_MAX_ATTEMPTS = int(os.environ.get("SUMMARY_MAX_ATTEMPTS", "3"))
+SUMMARY_RETRY_BASE_SECONDS = float(os.environ.get("SUMMARY_RETRY_BASE_SECONDS", "60"))
+SUMMARY_CLAIM_TIMEOUT_SECONDS = float(os.environ.get("SUMMARY_CLAIM_TIMEOUT_SECONDS", "600"))
+SUMMARY_RESUME_INTERVAL_MINUTES = 15
 
 
 async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -70,6 +77,38 @@ async def handle_text_message(update: Update, context: ContextTypes.DEFAULT_TYPE
     )
 
 
+def _summarize_thread(
+    chat_id: int,
+    thread_id: Optional[int],
+    since_time: datetime,
+    until_time: Optional[datetime] = None,
+) -> Optional[str]:
+    messages = db.get_messages_for_chat_since(chat_id, since_time, thread_id, until_time)
+    if not messages:
+        return None
+
+    lines = []
+    for m in messages:
+        author = m.user_name or "Unknown"
+        content = m.message_text.strip().replace("\n", " ")
+        lines.append(f"{author}: {content}")
+
+    messages_block = build_messages_block(lines)
+    return summarize_messages_text(messages_block)
+
+
+def _compose_chat_summary(thread_summaries: List[Tuple[Optional[int], str]], multi_thread: bool) -> str:
+    # Если одна тема (или основной чат без тем) — саммари как есть
+    if not multi_thread:
+        return thread_summaries[0][1]
+
+    all_summaries = []
+    for thread_id, thread_summary in thread_summaries:
+        thread_name = f"Тема {thread_id}" if thread_id else "Основной чат"
+        all_summaries.append(f"🔖 **{thread_name}**\n{thread_summary}")
+    return "\n\n" + "═" * 50 + "\n\n".join(all_summaries)
+
+
 async def summarize_messages_for_chat(chat_id: int) -> Optional[str]:
     since_time = datetime.now(timezone.utc) - timedelta(days=1)
     
@@ -79,72 +118,173 @@ async def summarize_messages_for_chat(chat_id: int) -> Optional[str]:
     if not thread_ids:
         return None
     
-    # Если есть только одна тема (или основной чат без тем)
-    if len(thread_ids) == 1:
-        messages = db.get_messages_for_chat_since(chat_id, since_time, thread_ids[0])
-        if not messages:
-            return None
-            
-        lines = []
-        for m in messages:
-            author = m.user_name or "Unknown"
-            content = m.message_text.strip().replace("\n", " ")
-            lines.append(f"{author}: {content}")
-
-        messages_block = build_messages_block(lines)
-        try:
-            summary = summarize_messages_text(messages_block)
-            return summary
-        except Exception as exc:  # noqa: BLE001
-            print(f"[summarize_messages_for_chat] Ошибка: {exc}")
-            return None
-    
     # Если несколько тем - создаём саммари для каждой темы отдельно
-    all_summaries = []
+    thread_summaries: List[Tuple[Optional[int], str]] = []
     for thread_id in thread_ids:
-        messages = db.get_messages_for_chat_since(chat_id, since_time, thread_id)
-        if not messages:
-            continue
-            
-        lines = []
-        for m in messages:
-            author = m.user_name or "Unknown"
-            content = m.message_text.strip().replace("\n", " ")
-            lines.append(f"{author}: {content}")
-
-        messages_block = build_messages_block(lines)
         try:
-            thread_summary = summarize_messages_text(messages_block)
-            thread_name = f"Тема {thread_id}" if thread_id else "Основной чат"
-            all_summaries.append(f"🔖 **{thread_name}**\n{thread_summary}")
+            thread_summary = _summarize_thread(chat_id, thread_id, since_time)
         except Exception as exc:  # noqa: BLE001
             print(f"[summarize_messages_for_chat] Ошибка для темы {thread_id}: {exc}")
             continue
+        if thread_summary:
+            thread_summaries.append((thread_id, thread_summary))
     
-    if not all_summaries:
+    if not thread_summaries:
         return None
         
-    return "\n\n" + "═" * 50 + "\n\n".join(all_summaries)
+    return _compose_chat_summary(thread_summaries, multi_thread=len(thread_ids) > 1)
+
+
+def current_summary_window(now: Optional[datetime] = None) -> Tuple[datetime, datetime]:
+    """Окно ежедневного саммари: сутки, заканчивающиеся в последние SUMMARY_HOUR_UTC:00 UTC.
+
+    Окно привязано к расписанию, а не к моменту запуска, поэтому перезапуск
+    и ручной прогон в тот же день попадают в тот же прогон в summary_runs.
+    """
+    now = now or datetime.now(timezone.utc)
+    window_end = now.astimezone(timezone.utc).replace(hour=SUMMARY_HOUR_UTC, minute=0, second=0, microsecond=0)
+    if window_end > now:
+        window_end -= timedelta(days=1)
+    return window_end - timedelta(days=1), window_end
+
+
+def _retry_at(attempts: int) -> datetime:
+    delay = SUMMARY_RETRY_BASE_SECONDS * 2 ** attempts
+    return datetime.now(timezone.utc) + timedelta(seconds=delay)
+
+
+async def _process_chat(bot: Bot, run: db.SummaryRun, chat_id: int) -> bool:
+    """Доделать саммари одного чата: саммаризировать захваченные темы и отправить их одним сообщением.
+
+    Возвращает False, если захватить ничего не удалось (работы нет или чат занят другим процессом).
+    """
+    claimed = db.claim_summary_run_chat(
+        run.id, chat_id, SUMMARY_MAX_ATTEMPTS, timedelta(seconds=SUMMARY_CLAIM_TIMEOUT_SECONDS)
+    )
+    if not claimed:
+        return False
+    owner = claimed[0].claimed_by or ""
+
+    for item in claimed:
+        if item.summary:
+            continue
+        try:
+            summary = _summarize_thread(chat_id, item.message_thread_id, run.window_start, run.window_end)
+        except Exception as exc:  # noqa: BLE001
+            summary, error = None, exc
+        else:
+            error = None
+        # Вызов LLM мог затянуться: продлеваем захват, а если его уже перехватили — отступаем
+        if not db.refresh_summary_run_claim(owner):
+            print(f"[summary_run] Захват чата {chat_id} перехвачен другим процессом")
+            return True
+        if error is not None:
+            print(f"[summary_run] Ошибка саммаризации {chat_id}/{item.message_thread_id}: {error}")
+            item.status = "failed"
+            db.fail_summary_run_item(item.id, f"summarize: {error}", _retry_at(item.attempts))
+        elif not summary:
+            item.status = "skipped"
+            db.update_summary_run_item(item.id, item.status)
+        else:
+            # Саммари сохраняем сразу: после падения до отправки LLM повторно не вызывается
+            item.summary = summary
+            db.update_summary_run_item(item.id, "in_progress", summary=summary)
+
+    held = [item for item in claimed if item.status == "in_progress" and item.summary]
+    chat_items = db.get_summary_run_items(run.id, chat_id)
+
+    # Чат уходит одним сообщением: ждём темы, у которых остались попытки, и паузу после неудачной отправки
+    waiting = any(
+        item.status == "summarized"
+        or (item.status == "failed" and item.summary is None and item.attempts < SUMMARY_MAX_ATTEMPTS)
+        for item in chat_items
+    )
+    if waiting:
+        for item in held:
+            db.update_summary_run_item(item.id, "summarized")
+        return True
+    if not held:
+        return True
+
+    text = _compose_chat_summary(
+        [(item.message_thread_id, item.summary or "") for item in held],
+        multi_thread=len(chat_items) > 1,
+    )
+    try:
+        await bot.send_message(chat_id=chat_id, text=text[:3800])
+    except Exception as exc:  # noqa: BLE001
+        print(f"[summary_run] Не удалось отправить саммари в {chat_id}: {exc}")
+        send_attempts = db.get_summary_run_chat_send_attempts(run.id, chat_id)
+        db.fail_summary_run_chat_send(run.id, chat_id, f"send: {exc}", _retry_at(send_attempts))
+        # Пока у чата остались попытки отправки, темы ждут её со своими саммари
+        status = "failed" if send_attempts + 1 >= SUMMARY_MAX_ATTEMPTS else "summarized"
+        for item in held:
+            db.update_summary_run_item(item.id, status, error=f"send: {exc}")
+        return True
+
+    for item in held:
+        db.update_summary_run_item(item.id, "sent")
+    return True
+
+
+async def process_summary_run(bot: Bot, run: db.SummaryRun) -> None:
+    """Доделать незавершённую работу прогона, повторяя упавшие элементы с экспоненциальной паузой.
+
+    Чаты захватываются атомарно (db.claim_summary_run_chat), поэтому бот и ручной
+    run_summary_send.py могут работать с одним прогоном одновременно без дублей.
+    Прогон завершается, когда не осталось ни необработанных элементов, ни повторов:
+    элементы, исчерпавшие попытки, остаются в статусе failed с причиной.
+    """
+    for chat_id in db.get_active_chat_ids_since(run.window_start, run.window_end):
+        for thread_id in db.get_active_thread_ids_for_chat_since(chat_id, run.window_start, run.window_end):
+            db.ensure_summary_run_item(run.id, chat_id, thread_id)
+
+    # Цикл ограничен попытками: каждый повтор увеличивает attempts элемента или send_attempts чата
+    while True:
+        chat_ids = sorted({item.chat_id for item in db.get_summary_run_items(run.id)})
+        claimed_any = False
+        for chat_id in chat_ids:
+            claimed_any = await _process_chat(bot, run, chat_id) or claimed_any
+
+        next_retry = db.get_next_summary_retry_time(run.id, SUMMARY_MAX_ATTEMPTS)
+        if next_retry is None:
+            break
+        delay = (next_retry - datetime.now(timezone.utc)).total_seconds()
+        # Повтор уже пора делать, но захватить нечего — этим чатом занят другой процесс
+        if delay <= 0 and not claimed_any:
+            break
+        delay = max(0.0, delay)
+        print(f"[summary_run] Есть упавшие элементы в прогоне {run.id}, повтор через {delay:.0f} с")
+        await asyncio.sleep(delay)
+
+    if db.is_summary_run_complete(run.id, SUMMARY_MAX_ATTEMPTS):
+        db.finish_summary_run(run.id)
+
+
+async def run_daily_summary(bot: Bot) -> None:
+    window_start, window_end = current_summary_window()
+    run = db.get_or_create_summary_run(window_start, window_end)
+    print(f"[send_daily_summary] Прогон {run.id} за окно {window_start} — {window_end}")
+    await process_summary_run(bot, run)
+
+
+async def resume_unfinished_summary_runs(bot: Bot) -> None:
+    # Если бот лежал в момент срабатывания cron, прогона за текущее окно ещё нет — заводим его
+    db.get_or_create_summary_run(*current_summary_window())
+    for run in db.get_unfinished_summary_runs():
+        print(f"[summary_run] Продолжаем прерванный прогон {run.id} за окно {run.window_start} — {run.window_end}")
+        await process_summary_run(bot, run)
 
 
 async def send_daily_summary(bot: Bot) -> None:
     print(f"[send_daily_summary] Запуск в {datetime.now(timezone.utc)}")
-    since_time = datetime.now(timezone.utc) - timedelta(days=1)
-    chat_ids = db.get_active_chat_ids_since(since_time)
-    print(f"[send_daily_summary] Найдено активных чатов: {len(chat_ids)}")
-
-    for chat_id in chat_ids:
-        summary = await summarize_messages_for_chat(chat_id)
-        if summary:
-            try:
-                await bot.send_message(chat_id=chat_id, text=summary[:3800])
-            except Exception as exc:  # noqa: BLE001
-                print(f"[send_daily_summary] Не удалось отправить саммари в {chat_id}: {exc}")
+    await run_daily_summary(bot)
 
     try:
         deleted = db.delete_messages_older_than(SUMMARY_RETENTION_DAYS)
         if deleted:
             print(f"[cleanup] Удалено старых сообщений: {deleted}")
+        db.delete_summary_runs_older_than(SUMMARY_RETENTION_DAYS)
     except Exception as exc:  # noqa: BLE001
         print(f"[cleanup] Ошибка очистки: {exc}")
 
@@ -159,13 +299,26 @@ def setup_scheduler(app: Application) -> AsyncIOScheduler:
 
     scheduler.add_job(
         job_wrapper,
-        trigger=CronTrigger(hour=21, minute=0, timezone=timezone.utc),
+        trigger=CronTrigger(hour=SUMMARY_HOUR_UTC, minute=0, timezone=timezone.utc),
+    )
+    # Прогоны, прерванные перезапуском или падением, доделываем сразу после старта и затем
+    # периодически: так подхватываются захваты упавшего процесса и отложенные повторы
+    scheduler.add_job(
+        resume_unfinished_summary_runs,
+        trigger=IntervalTrigger(minutes=SUMMARY_RESUME_INTERVAL_MINUTES, timezone=timezone.utc),
+        next_run_time=datetime.now(timezone.utc),
+        args=[app.bot],
     )
     scheduler.start()
-    print("[scheduler] Планировщик запущен на 21:00 UTC")
+    print(f"[scheduler] Планировщик запущен на {SUMMARY_HOUR_UTC}:00 UTC")
     return scheduler
 
 
+async def post_init(app: Application) -> None:
+    # Планировщик запускаем после инициализации бота, чтобы job'ы могли сразу отправлять сообщения
+    setup_scheduler(app)
+
+
 def main() -> None:
     if not TELEGRAM_BOT_TOKEN:
         raise RuntimeError("TELEGRAM_BOT_TOKEN не задан в окружении")
@@ -175,6 +328,7 @@ def main() -> None:
     application = (
         ApplicationBuilder()
         .token(TELEGRAM_BOT_TOKEN)
+        .post_init(post_init)
         .build()
     )
 
@@ -185,8 +339,6 @@ def main() -> None:
     # Поддержка форум-групп (сообщения в темах)
     application.add_handler(MessageHandler(filters.ChatType.SUPERGROUP & filters.TEXT & (~filters.COMMAND), handle_text_message))
 
-    setup_scheduler(application)
-
     application.run_polling(allowed_updates=Update.ALL_TYPES)
 
 
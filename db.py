@@ -2,10 +2,11 @@ from __future__ import annotations
 
 import os
 import sqlite3
+import uuid
 from contextlib import contextmanager
 from dataclasses import dataclass
 from datetime import datetime, timedelta, timezone
-from typing import Generator, List, Optional
+from typing import Generator, List, Optional, Sequence, Tuple
 
 
 DATABASE_PATH = os.environ.get("SQLITE_DB_PATH", os.path.abspath("chat_logs.db"))
@@ -54,18 +55,100 @@ def initialize_database() -> None:
             cur.execute("ALTER TABLE messages ADD COLUMN message_thread_id INTEGER;")
             print("Добавлена колонка message_thread_id в таблицу messages")
         
+        # Прогресс импорта истории из экспорта Telegram Desktop (см. import_history.py)
         cur.execute(
             """
-            CREATE INDEX IF NOT EXISTS idx_messages_chat_time
-            ON messages(chat_id, timestamp);
+            CREATE TABLE IF NOT EXISTS import_progress (
+                chat_id INTEGER PRIMARY KEY,
+                last_message_id INTEGER NOT NULL,
+                rows_imported INTEGER NOT NULL DEFAULT 0,
+                last_timestamp DATETIME NOT NULL,
+                updated_at DATETIME NOT NULL
+            );
+            """
+        )
+
+        # Состояние ежедневных прогонов саммари: окно прогона и статус по каждой паре (чат, тема)
+        cur.execute(
+            """
+            CREATE TABLE IF NOT EXISTS summary_runs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                window_start DATETIME NOT NULL,
+                window_end DATETIME NOT NULL UNIQUE,
+                started_at DATETIME NOT NULL,
+                finished_at DATETIME
+            );
+            """
+        )
+        cur.execute(
+            """
+            CREATE TABLE IF NOT EXISTS summary_run_items (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                run_id INTEGER NOT NULL REFERENCES summary_runs(id) ON DELETE CASCADE,
+                chat_id INTEGER NOT NULL,
+                message_thread_id INTEGER,
+                status TEXT NOT NULL DEFAULT 'pending',
+                summary TEXT,
+                error TEXT,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_attempt_at DATETIME,
+                claimed_by TEXT,
+                claimed_at DATETIME,
+                updated_at DATETIME NOT NULL
+            );
+            """
+        )
+        # Чат отправляется одним сообщением, поэтому попытки отправки считаются на чат, а не на тему
+        cur.execute(
+            """
+            CREATE TABLE IF NOT EXISTS summary_run_chats (
+                run_id INTEGER NOT NULL REFERENCES summary_runs(id) ON DELETE CASCADE,
+                chat_id INTEGER NOT NULL,
+                send_attempts INTEGER NOT NULL DEFAULT 0,
+                next_attempt_at DATETIME,
+                error TEXT,
+                PRIMARY KEY (run_id, chat_id)
+            );
             """
         )
+        # Одна запись на (прогон, чат, тема); тема NULL (основной чат) сводится к 0
         cur.execute(
             """
-            CREATE INDEX IF NOT EXISTS idx_messages_chat_thread_time
-            ON messages(chat_id, message_thread_id, timestamp);
+            CREATE UNIQUE INDEX IF NOT EXISTS idx_summary_run_items_run_chat_thread
+            ON summary_run_items(run_id, chat_id, IFNULL(message_thread_id, 0));
             """
         )
+
+        _create_message_indexes(cur)
+        conn.commit()
+
+
+def _create_message_indexes(cur: sqlite3.Cursor) -> None:
+    cur.execute(
+        """
+        CREATE INDEX IF NOT EXISTS idx_messages_chat_time
+        ON messages(chat_id, timestamp);
+        """
+    )
+    cur.execute(
+        """
+        CREATE INDEX IF NOT EXISTS idx_messages_chat_thread_time
+        ON messages(chat_id, message_thread_id, timestamp);
+        """
+    )
+
+
+def create_message_indexes() -> None:
+    with get_connection() as conn:
+        _create_message_indexes(conn.cursor())
+        conn.commit()
+
+
+def drop_message_indexes() -> None:
+    """Удалить индексы messages на время массовой вставки (пересоздаются create_message_indexes)."""
+    with get_connection() as conn:
+        conn.execute("DROP INDEX IF EXISTS idx_messages_chat_time;")
+        conn.execute("DROP INDEX IF EXISTS idx_messages_chat_thread_time;")
         conn.commit()
 
 
@@ -89,18 +172,102 @@ def add_message(chat_id: int, user_name: Optional[str], message_text: str, times
         conn.commit()
 
 
-def get_messages_for_chat_since(chat_id: int, since_time: datetime, message_thread_id: Optional[int] = None) -> List[ChatMessage]:
+@dataclass
+class ImportProgress:
+    chat_id: int
+    last_message_id: int
+    rows_imported: int
+    last_timestamp: datetime
+
+
+def get_import_progress(chat_id: int) -> Optional[ImportProgress]:
+    with get_connection() as conn:
+        r = conn.execute(
+            "SELECT chat_id, last_message_id, rows_imported, last_timestamp FROM import_progress WHERE chat_id = ?",
+            (chat_id,),
+        ).fetchone()
+    if r is None:
+        return None
+    return ImportProgress(
+        chat_id=int(r["chat_id"]),  # type: ignore[index]
+        last_message_id=int(r["last_message_id"]),  # type: ignore[index]
+        rows_imported=int(r["rows_imported"]),  # type: ignore[index]
+        last_timestamp=_parse_ts(r["last_timestamp"]),  # type: ignore[index]
+    )
+
+
+def add_messages_batch(
+    rows: Sequence[Tuple[int, Optional[int], Optional[str], str, str]],
+    chat_id: int,
+    last_message_id: int,
+    last_timestamp: datetime,
+) -> None:
+    """Записать пачку сообщений одной транзакцией вместе с отметкой прогресса импорта.
+
+    rows — кортежи (chat_id, message_thread_id, user_name, message_text, timestamp_iso).
+    Пачка, last_message_id и время этого сообщения фиксируются атомарно, поэтому
+    после сбоя импорт продолжается ровно с первого незаписанного сообщения.
+    """
+    last_iso = last_timestamp.astimezone(timezone.utc).isoformat()
+    now_iso = datetime.now(timezone.utc).isoformat()
+    with get_connection() as conn:
+        conn.executemany(
+            "INSERT INTO messages (chat_id, message_thread_id, user_name, message_text, timestamp) VALUES (?, ?, ?, ?, ?)",
+            rows,
+        )
+        conn.execute(
+            """
+            INSERT INTO import_progress (chat_id, last_message_id, rows_imported, last_timestamp, updated_at)
+            VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT(chat_id) DO UPDATE SET
+                last_message_id = excluded.last_message_id,
+                last_timestamp = excluded.last_timestamp,
+                rows_imported = import_progress.rows_imported + excluded.rows_imported,
+                updated_at = excluded.updated_at
+            """,
+            (chat_id, last_message_id, len(rows), last_iso, now_iso),
+        )
+        conn.commit()
+
+
+def get_earliest_message_time(chat_id: int, after_time: Optional[datetime] = None) -> Optional[datetime]:
+    """Время самого раннего сообщения чата (строго позже after_time, если задано)."""
+    with get_connection() as conn:
+        if after_time is not None:
+            r = conn.execute(
+                "SELECT MIN(timestamp) FROM messages WHERE chat_id = ? AND timestamp > ?",
+                (chat_id, after_time.astimezone(timezone.utc).isoformat()),
+            ).fetchone()
+        else:
+            r = conn.execute("SELECT MIN(timestamp) FROM messages WHERE chat_id = ?", (chat_id,)).fetchone()
+    if r is None or r[0] is None:
+        return None
+    return _parse_ts(r[0])
+
+
+def has_messages() -> bool:
+    with get_connection() as conn:
+        return conn.execute("SELECT 1 FROM messages LIMIT 1").fetchone() is not None
+
+
+def get_messages_for_chat_since(
+    chat_id: int,
+    since_time: datetime,
+    message_thread_id: Optional[int] = None,
+    until_time: Optional[datetime] = None,
+) -> List[ChatMessage]:
     since_iso = since_time.astimezone(timezone.utc).isoformat()
+    until_iso = _until_iso(until_time)
     with get_connection() as conn:
         if message_thread_id is not None:
             rows = conn.execute(
-                "SELECT id, chat_id, message_thread_id, user_name, message_text, timestamp FROM messages WHERE chat_id = ? AND message_thread_id = ? AND timestamp >= ? ORDER BY timestamp ASC",
-                (chat_id, message_thread_id, since_iso),
+                "SELECT id, chat_id, message_thread_id, user_name, message_text, timestamp FROM messages WHERE chat_id = ? AND message_thread_id = ? AND timestamp >= ? AND timestamp < ? ORDER BY timestamp ASC",
+                (chat_id, message_thread_id, since_iso, until_iso),
             ).fetchall()
         else:
             rows = conn.execute(
-                "SELECT id, chat_id, message_thread_id, user_name, message_text, timestamp FROM messages WHERE chat_id = ? AND timestamp >= ? ORDER BY timestamp ASC",
-                (chat_id, since_iso),
+                "SELECT id, chat_id, message_thread_id, user_name, message_text, timestamp FROM messages WHERE chat_id = ? AND timestamp >= ? AND timestamp < ? ORDER BY timestamp ASC",
+                (chat_id, since_iso, until_iso),
             ).fetchall()
     messages: List[ChatMessage] = []
     for r in rows:
@@ -118,23 +285,27 @@ def get_messages_for_chat_since(chat_id: int, since_time: datetime, message_thre
     return messages
 
 
-def get_active_chat_ids_since(since_time: datetime) -> List[int]:
+def get_active_chat_ids_since(since_time: datetime, until_time: Optional[datetime] = None) -> List[int]:
     since_iso = since_time.astimezone(timezone.utc).isoformat()
+    until_iso = _until_iso(until_time)
     with get_connection() as conn:
         rows = conn.execute(
-            "SELECT DISTINCT chat_id FROM messages WHERE timestamp >= ? ORDER BY chat_id",
-            (since_iso,),
+            "SELECT DISTINCT chat_id FROM messages WHERE timestamp >= ? AND timestamp < ? ORDER BY chat_id",
+            (since_iso, until_iso),
         ).fetchall()
     return [int(r[0]) for r in rows]
 
 
-def get_active_thread_ids_for_chat_since(chat_id: int, since_time: datetime) -> List[Optional[int]]:
+def get_active_thread_ids_for_chat_since(
+    chat_id: int, since_time: datetime, until_time: Optional[datetime] = None
+) -> List[Optional[int]]:
     """Получить список активных тем (thread_id) в чате за период."""
     since_iso = since_time.astimezone(timezone.utc).isoformat()
+    until_iso = _until_iso(until_time)
     with get_connection() as conn:
         rows = conn.execute(
-            "SELECT DISTINCT message_thread_id FROM messages WHERE chat_id = ? AND timestamp >= ? ORDER BY message_thread_id",
-            (chat_id, since_iso),
+            "SELECT DISTINCT message_thread_id FROM messages WHERE chat_id = ? AND timestamp >= ? AND timestamp < ? ORDER BY message_thread_id",
+            (chat_id, since_iso, until_iso),
         ).fetchall()
     return [int(r[0]) if r[0] is not None else None for r in rows]
 
@@ -148,6 +319,286 @@ def delete_messages_older_than(days: int) -> int:
         return cur.rowcount
 
 
+@dataclass
+class SummaryRun:
+    id: int
+    window_start: datetime
+    window_end: datetime
+    finished_at: Optional[datetime]
+
+
+@dataclass
+class SummaryRunItem:
+    id: int
+    run_id: int
+    chat_id: int
+    message_thread_id: Optional[int]
+    status: str  # pending | in_progress | summarized | sent | skipped | failed
+    summary: Optional[str]
+    error: Optional[str]
+    attempts: int  # число неудачных попыток саммаризации
+    claimed_by: Optional[str]
+
+
+def _row_to_summary_run(r: sqlite3.Row) -> SummaryRun:
+    return SummaryRun(
+        id=int(r["id"]),
+        window_start=_parse_ts(r["window_start"]),
+        window_end=_parse_ts(r["window_end"]),
+        finished_at=(_parse_ts(r["finished_at"]) if r["finished_at"] is not None else None),
+    )
+
+
+def get_or_create_summary_run(window_start: datetime, window_end: datetime) -> SummaryRun:
+    """Найти прогон за окно, заканчивающееся в window_end, или завести новый."""
+    start_iso = window_start.astimezone(timezone.utc).isoformat()
+    end_iso = window_end.astimezone(timezone.utc).isoformat()
+    now_iso = datetime.now(timezone.utc).isoformat()
+    with get_connection() as conn:
+        conn.execute(
+            "INSERT OR IGNORE INTO summary_runs (window_start, window_end, started_at) VALUES (?, ?, ?)",
+            (start_iso, end_iso, now_iso),
+        )
+        conn.commit()
+        r = conn.execute(
+            "SELECT id, window_start, window_end, finished_at FROM summary_runs WHERE window_end = ?",
+            (end_iso,),
+        ).fetchone()
+    return _row_to_summary_run(r)
+
+
+def get_unfinished_summary_runs() -> List[SummaryRun]:
+    with get_connection() as conn:
+        rows = conn.execute(
+            "SELECT id, window_start, window_end, finished_at FROM summary_runs WHERE finished_at IS NULL ORDER BY window_end",
+        ).fetchall()
+    return [_row_to_summary_run(r) for r in rows]
+
+
+def finish_summary_run(run_id: int) -> None:
+    with get_connection() as conn:
+        conn.execute(
+            "UPDATE summary_runs SET finished_at = ? WHERE id = ?",
+            (datetime.now(timezone.utc).isoformat(), run_id),
+        )
+        conn.commit()
+
+
+def ensure_summary_run_item(run_id: int, chat_id: int, message_thread_id: Optional[int]) -> None:
+    with get_connection() as conn:
+        conn.execute(
+            "INSERT OR IGNORE INTO summary_run_items (run_id, chat_id, message_thread_id, updated_at) VALUES (?, ?, ?, ?)",
+            (run_id, chat_id, message_thread_id, datetime.now(timezone.utc).isoformat()),
+        )
+        conn.commit()
+
+
+_SUMMARY_RUN_ITEM_COLUMNS = "id, run_id, chat_id, message_thread_id, status, summary, error, attempts, claimed_by"
+
+
+def _row_to_summary_run_item(r: sqlite3.Row) -> SummaryRunItem:
+    return SummaryRunItem(
+        id=int(r["id"]),
+        run_id=int(r["run_id"]),
+        chat_id=int(r["chat_id"]),
+        message_thread_id=(int(r["message_thread_id"]) if r["message_thread_id"] is not None else None),
+        status=str(r["status"]),
+        summary=r["summary"],
+        error=r["error"],
+        attempts=int(r["attempts"]),
+        claimed_by=r["claimed_by"],
+    )
+
+
+def get_summary_run_items(run_id: int, chat_id: Optional[int] = None) -> List[SummaryRunItem]:
+    with get_connection() as conn:
+        if chat_id is not None:
+            rows = conn.execute(
+                f"SELECT {_SUMMARY_RUN_ITEM_COLUMNS} FROM summary_run_items WHERE run_id = ? AND chat_id = ? ORDER BY message_thread_id",
+                (run_id, chat_id),
+            ).fetchall()
+        else:
+            rows = conn.execute(
+                f"SELECT {_SUMMARY_RUN_ITEM_COLUMNS} FROM summary_run_items WHERE run_id = ? ORDER BY chat_id, message_thread_id",
+                (run_id,),
+            ).fetchall()
+    return [_row_to_summary_run_item(r) for r in rows]
+
+
+def claim_summary_run_chat(run_id: int, chat_id: int, max_attempts: int, claim_timeout: timedelta) -> List[SummaryRunItem]:
+    """Атомарно захватить незавершённые элементы чата для обработки (status = 'in_progress').
+
+    Захватываются pending; summarized, если у чата истекла пауза до повторной отправки;
+    failed без саммари, у которых остались попытки и истекла пауза до повтора.
+    Если по чату уже работает другой процесс (его захват моложе claim_timeout),
+    ничего не захватывается — так один чат не саммаризируется и не отправляется
+    дважды. Захват старше claim_timeout считается брошенным упавшим процессом и
+    перехватывается. Возвращает захваченные элементы.
+    """
+    now = datetime.now(timezone.utc)
+    now_iso = now.isoformat()
+    stale_iso = (now - claim_timeout).isoformat()
+    owner = uuid.uuid4().hex
+    with get_connection() as conn:
+        # BEGIN IMMEDIATE сразу берёт блокировку на запись: проверка и захват идут одной транзакцией
+        conn.execute("BEGIN IMMEDIATE")
+        busy = conn.execute(
+            "SELECT 1 FROM summary_run_items WHERE run_id = ? AND chat_id = ? AND status = 'in_progress' AND claimed_at >= ?",
+            (run_id, chat_id, stale_iso),
+        ).fetchone()
+        if busy is not None:
+            conn.rollback()
+            return []
+        conn.execute(
+            """
+            UPDATE summary_run_items
+            SET status = 'in_progress', claimed_by = ?, claimed_at = ?, updated_at = ?
+            WHERE run_id = ? AND chat_id = ? AND (
+                status IN ('pending', 'in_progress')
+                OR (status = 'summarized' AND NOT EXISTS (
+                    SELECT 1 FROM summary_run_chats AS c
+                    WHERE c.run_id = summary_run_items.run_id AND c.chat_id = summary_run_items.chat_id
+                        AND c.next_attempt_at > ?
+                ))
+                OR (status = 'failed' AND summary IS NULL AND attempts < ?
+                    AND (next_attempt_at IS NULL OR next_attempt_at <= ?))
+            )
+            """,
+            (owner, now_iso, now_iso, run_id, chat_id, now_iso, max_attempts, now_iso),
+        )
+        conn.commit()
+        rows = conn.execute(
+            f"SELECT {_SUMMARY_RUN_ITEM_COLUMNS} FROM summary_run_items WHERE claimed_by = ? AND status = 'in_progress' ORDER BY message_thread_id",
+            (owner,),
+        ).fetchall()
+    return [_row_to_summary_run_item(r) for r in rows]
+
+
+def refresh_summary_run_claim(owner: str) -> int:
+    """Продлить захват владельца owner. Возвращает число элементов, которые он всё ещё держит."""
+    now_iso = datetime.now(timezone.utc).isoformat()
+    with get_connection() as conn:
+        cur = conn.execute(
+            "UPDATE summary_run_items SET claimed_at = ? WHERE claimed_by = ? AND status = 'in_progress'",
+            (now_iso, owner),
+        )
+        conn.commit()
+        return cur.rowcount
+
+
+def update_summary_run_item(item_id: int, status: str, summary: Optional[str] = None, error: Optional[str] = None) -> None:
+    """Обновить статус элемента прогона. Уже сохранённое саммари не затирается."""
+    with get_connection() as conn:
+        conn.execute(
+            "UPDATE summary_run_items SET status = ?, summary = COALESCE(?, summary), error = ?, updated_at = ? WHERE id = ?",
+            (status, summary, error, datetime.now(timezone.utc).isoformat(), item_id),
+        )
+        conn.commit()
+
+
+def fail_summary_run_item(item_id: int, error: str, next_attempt_at: datetime) -> None:
+    """Отметить неудачную саммаризацию: attempts растёт, повтор не раньше next_attempt_at."""
+    with get_connection() as conn:
+        conn.execute(
+            """
+            UPDATE summary_run_items
+            SET status = 'failed', error = ?, attempts = attempts + 1, next_attempt_at = ?, updated_at = ?
+            WHERE id = ?
+            """,
+            (error, next_attempt_at.astimezone(timezone.utc).isoformat(), datetime.now(timezone.utc).isoformat(), item_id),
+        )
+        conn.commit()
+
+
+def get_summary_run_chat_send_attempts(run_id: int, chat_id: int) -> int:
+    with get_connection() as conn:
+        r = conn.execute(
+            "SELECT send_attempts FROM summary_run_chats WHERE run_id = ? AND chat_id = ?",
+            (run_id, chat_id),
+        ).fetchone()
+    return int(r[0]) if r is not None else 0
+
+
+def fail_summary_run_chat_send(run_id: int, chat_id: int, error: str, next_attempt_at: datetime) -> None:
+    """Отметить неудачную отправку чата: send_attempts растёт, повтор не раньше next_attempt_at."""
+    with get_connection() as conn:
+        conn.execute(
+            """
+            INSERT INTO summary_run_chats (run_id, chat_id, send_attempts, next_attempt_at, error)
+            VALUES (?, ?, 1, ?, ?)
+            ON CONFLICT(run_id, chat_id) DO UPDATE SET
+                send_attempts = summary_run_chats.send_attempts + 1,
+                next_attempt_at = excluded.next_attempt_at,
+                error = excluded.error
+            """,
+            (run_id, chat_id, next_attempt_at.astimezone(timezone.utc).isoformat(), error),
+        )
+        conn.commit()
+
+
+def get_next_summary_retry_time(run_id: int, max_attempts: int) -> Optional[datetime]:
+    """Ближайшее время повтора: упавшие саммаризации с оставшимися попытками и отложенные отправки чатов."""
+    with get_connection() as conn:
+        r = conn.execute(
+            """
+            SELECT MIN(retry_at) FROM (
+                SELECT IFNULL(next_attempt_at, updated_at) AS retry_at FROM summary_run_items
+                WHERE run_id = ? AND status = 'failed' AND summary IS NULL AND attempts < ?
+                UNION ALL
+                SELECT c.next_attempt_at FROM summary_run_chats AS c
+                WHERE c.run_id = ? AND EXISTS (
+                    SELECT 1 FROM summary_run_items AS i
+                    WHERE i.run_id = c.run_id AND i.chat_id = c.chat_id AND i.status = 'summarized'
+                )
+            )
+            """,
+            (run_id, max_attempts, run_id),
+        ).fetchone()
+    if r is None or r[0] is None:
+        return None
+    return _parse_ts(r[0])
+
+
+def is_summary_run_complete(run_id: int, max_attempts: int) -> bool:
+    """Прогон завершён, когда не осталось работы: всё отправлено, пропущено или исчерпало попытки."""
+    with get_connection() as conn:
+        r = conn.execute(
+            """
+            SELECT 1 FROM summary_run_items
+            WHERE run_id = ? AND (
+                status IN ('pending', 'in_progress', 'summarized')
+                OR (status = 'failed' AND summary IS NULL AND attempts < ?)
+            )
+            LIMIT 1
+            """,
+            (run_id, max_attempts),
+        ).fetchone()
+    return r is None
+
+
+def delete_summary_runs_older_than(days: int) -> int:
+    threshold_iso = (datetime.now(timezone.utc) - timedelta(days=days)).isoformat()
+    with get_connection() as conn:
+        conn.execute(
+            "DELETE FROM summary_run_items WHERE run_id IN (SELECT id FROM summary_runs WHERE window_end < ?)",
+            (threshold_iso,),
+        )
+        conn.execute(
+            "DELETE FROM summary_run_chats WHERE run_id IN (SELECT id FROM summary_runs WHERE window_end < ?)",
+            (threshold_iso,),
+        )
+        cur = conn.execute("DELETE FROM summary_runs WHERE window_end < ?", (threshold_iso,))
+        conn.commit()
+        return cur.rowcount
+
+
+def _until_iso(until_time: Optional[datetime]) -> str:
+    # Без верхней границы окна — все сообщения до текущего момента (и с часами, убежавшими вперёд)
+    if until_time is None:
+        return datetime.max.replace(tzinfo=timezone.utc).isoformat()
+    return until_time.astimezone(timezone.utc).isoformat()
+
+
 def _parse_ts(value: str) -> datetime:
     dt = datetime.fromisoformat(value)
     if dt.tzinfo is None:
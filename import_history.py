@@ -0,0 +1,277 @@
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import sys
+import time
+from datetime import datetime, timezone
+from typing import Any, Dict, Iterator, List, Optional, TextIO, Tuple
+
+import db
+
+
+CHUNK_SIZE = 1 << 20  # 1 MiB
+BATCH_SIZE = int(os.environ.get("IMPORT_BATCH_SIZE", "50000"))
+
+# Типы чатов в экспорте Telegram Desktop, которые в Bot API имеют id вида -100XXXXXXXXXX
+_SUPERGROUP_OR_CHANNEL_TYPES = {
+    "private_supergroup",
+    "public_supergroup",
+    "private_channel",
+    "public_channel",
+}
+
+_WHITESPACE = " \t\r\n"
+
+
+class ExportReader:
+    """Потоковый разбор result.json из экспорта истории чата Telegram Desktop.
+
+    Файл читается блоками по CHUNK_SIZE; в памяти одновременно находится только
+    текущий блок и одно сообщение. Скалярные поля верхнего уровня, идущие до
+    "messages" (name, type, id), доступны в header до начала итерации по сообщениям.
+    """
+
+    def __init__(self, fp: TextIO) -> None:
+        self._fp = fp
+        self._decoder = json.JSONDecoder()
+        self._buf = ""
+        self._pos = 0
+        self._eof = False
+        self.header: Dict[str, Any] = {}
+        self._read_header()
+
+    def _fill(self) -> bool:
+        if self._eof:
+            return False
+        chunk = self._fp.read(CHUNK_SIZE)
+        if not chunk:
+            self._eof = True
+            return False
+        self._buf = self._buf[self._pos:] + chunk
+        self._pos = 0
+        return True
+
+    def _skip_ws(self) -> None:
+        while True:
+            while self._pos < len(self._buf) and self._buf[self._pos] in _WHITESPACE:
+                self._pos += 1
+            if self._pos < len(self._buf) or not self._fill():
+                return
+
+    def _peek(self) -> str:
+        self._skip_ws()
+        if self._pos >= len(self._buf):
+            raise ValueError("Неожиданный конец файла экспорта")
+        return self._buf[self._pos]
+
+    def _expect(self, char: str) -> None:
+        if self._peek() != char:
+            raise ValueError(f"Ожидался '{char}' в позиции {self._pos}, найдено '{self._buf[self._pos]}'")
+        self._pos += 1
+
+    def _decode_value(self) -> Any:
+        self._skip_ws()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buf, self._pos)
+            except json.JSONDecodeError:
+                # Значение обрезано границей блока — дочитываем и пробуем снова
+                if not self._fill():
+                    raise
+                continue
+            # Число на границе блока может быть прочитано не полностью
+            if end == len(self._buf) and not self._eof and isinstance(value, (int, float)):
+                self._fill()
+                continue
+            self._pos = end
+            return value
+
+    def _read_header(self) -> None:
+        self._expect("{")
+        while True:
+            if self._peek() == "}":
+                raise ValueError("В экспорте нет списка messages (нужен экспорт одного чата)")
+            key = self._decode_value()
+            self._expect(":")
+            if key == "messages":
+                self._expect("[")
+                return
+            # В экспорте одного чата до messages идут только скаляры (name, type, id).
+            # Вложенный объект или список — признак экспорта всего аккаунта ("chats": {"list": ...}),
+            # который пришлось бы целиком разобрать в память, поэтому останавливаемся сразу
+            if self._peek() in "{[":
+                raise ValueError(f"Неожиданное поле '{key}' до messages: нужен экспорт одного чата, а не всего аккаунта")
+            self.header[key] = self._decode_value()
+            if self._peek() == ",":
+                self._pos += 1
+
+    def __iter__(self) -> Iterator[Dict[str, Any]]:
+        if self._peek() == "]":
+            self._pos += 1
+            return
+        while True:
+            yield self._decode_value()
+            char = self._peek()
+            self._pos += 1
+            if char == "]":
+                return
+            if char != ",":
+                raise ValueError(f"Ожидался ',' или ']' в списке messages, найдено '{char}'")
+
+
+def bot_api_chat_id(export_type: str, export_id: int) -> int:
+    """Перевести id чата из экспорта в формат Bot API, под которым бот пишет в messages."""
+    if export_type in _SUPERGROUP_OR_CHANNEL_TYPES:
+        return -(10**12 + export_id)
+    if export_type == "private_group":
+        return -export_id
+    return export_id
+
+
+def message_text(raw: Dict[str, Any]) -> str:
+    text = raw.get("text", "")
+    if isinstance(text, str):
+        return text
+    # Форматированный текст хранится списком строк и сущностей {"type": ..., "text": ...}
+    return "".join(part if isinstance(part, str) else str(part.get("text", "")) for part in text)
+
+
+def message_timestamp(raw: Dict[str, Any]) -> datetime:
+    unixtime = raw.get("date_unixtime")
+    if unixtime is not None:
+        return datetime.fromtimestamp(int(unixtime), tz=timezone.utc)
+    # В старых экспортах есть только date — локальное время машины, делавшей экспорт
+    return datetime.fromisoformat(raw["date"]).astimezone(timezone.utc)
+
+
+def peak_memory_mb() -> Optional[float]:
+    try:
+        import resource
+    except ImportError:  # Windows
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux отдаёт килобайты, macOS — байты
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def import_export(
+    path: str,
+    chat_id: Optional[int] = None,
+    batch_size: int = BATCH_SIZE,
+    defer_indexes: Optional[bool] = None,
+) -> Tuple[int, int]:
+    """Импортировать экспорт в messages. Возвращает (записано строк, пропущено сообщений).
+
+    defer_indexes — снять индексы messages на время загрузки и построить их в конце.
+    По умолчанию включается только для пустой таблицы messages: на живой базе без
+    индексов замедлятся запросы бота, а небольшой догрузке перестроение не окупается.
+    """
+    with open(path, "r", encoding="utf-8") as fp:
+        reader = ExportReader(fp)
+        if chat_id is None:
+            if "id" not in reader.header:
+                raise ValueError("В экспорте нет id чата, укажите --chat-id")
+            chat_id = bot_api_chat_id(str(reader.header.get("type", "")), int(reader.header["id"]))
+
+        # Всё, что бот уже сохранил сам, не дублируем: берём историю только до первого
+        # живого сообщения, записанного после уже импортированной части
+        progress = db.get_import_progress(chat_id)
+        if progress is not None:
+            last_imported_id = progress.last_message_id
+            cutoff = db.get_earliest_message_time(chat_id, after_time=progress.last_timestamp)
+            print(f"Продолжаем импорт чата {chat_id} после сообщения {last_imported_id} (уже записано {progress.rows_imported})")
+        else:
+            last_imported_id = 0
+            cutoff = db.get_earliest_message_time(chat_id)
+            print(f"Импорт чата {chat_id} ({reader.header.get('name', '')})")
+
+        # id сообщения -> id темы; нужен для сообщений, отвечающих на сообщения внутри темы
+        topic_of: Dict[int, int] = {}
+        batch: List[Tuple[int, Optional[int], Optional[str], str, str]] = []
+        written = 0
+        skipped = 0
+        batch_last_id = last_imported_id
+        batch_last_ts: Optional[datetime] = None
+
+        if defer_indexes is None:
+            defer_indexes = not db.has_messages()
+        if defer_indexes:
+            db.drop_message_indexes()
+        try:
+            for raw in reader:
+                msg_id = int(raw.get("id", 0))
+                thread_id: Optional[int] = None
+                if raw.get("action") == "topic_created":
+                    topic_of[msg_id] = msg_id
+                else:
+                    reply_to = raw.get("reply_to_message_id")
+                    if reply_to is not None:
+                        thread_id = topic_of.get(int(reply_to))
+                        if thread_id is not None:
+                            topic_of[msg_id] = thread_id
+
+                # Сообщения до контрольной точки проходим только ради карты тем
+                if msg_id <= last_imported_id:
+                    continue
+                timestamp = message_timestamp(raw)
+                batch_last_id, batch_last_ts = msg_id, timestamp
+
+                text = message_text(raw)
+                if raw.get("type") != "message" or not text:
+                    skipped += 1
+                    continue
+                if cutoff is not None and timestamp >= cutoff:
+                    skipped += 1
+                    continue
+
+                batch.append((chat_id, thread_id, raw.get("from"), text, timestamp.isoformat()))
+                if len(batch) >= batch_size:
+                    db.add_messages_batch(batch, chat_id, batch_last_id, timestamp)
+                    written += len(batch)
+                    batch = []
+                    print(f"  записано {written}...")
+
+            if batch_last_ts is not None:
+                db.add_messages_batch(batch, chat_id, batch_last_id, batch_last_ts)
+                written += len(batch)
+        finally:
+            if defer_indexes:
+                print("Построение индексов...")
+                db.create_message_indexes()
+
+    return written, skipped
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Импорт истории чата из JSON-экспорта Telegram Desktop")
+    parser.add_argument("path", help="путь к result.json")
+    parser.add_argument("--chat-id", type=int, default=None, help="chat_id в формате Bot API (по умолчанию — из экспорта)")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE, help="строк на одну транзакцию")
+    parser.add_argument(
+        "--defer-indexes",
+        action="store_true",
+        default=None,
+        help="снять индексы на время загрузки и в конце построить заново (бот должен быть остановлен); "
+        "по умолчанию — только если таблица messages пуста",
+    )
+    args = parser.parse_args()
+
+    db.initialize_database()
+
+    started = time.perf_counter()
+    written, skipped = import_export(
+        args.path, chat_id=args.chat_id, batch_size=args.batch_size, defer_indexes=args.defer_indexes
+    )
+    elapsed = time.perf_counter() - started
+
+    rate = written / elapsed if elapsed > 0 else 0.0
+    print(f"Готово: записано {written} сообщений, пропущено {skipped} за {elapsed:.1f} с ({rate:.0f} строк/с)")
+    peak = peak_memory_mb()
+    if peak is not None:
+        print(f"Пиковое потребление памяти: {peak:.1f} МБ")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,204 @@
+"""
+Тесты импорта истории из JSON-экспорта Telegram Desktop (import_history.py).
+"""
+
+from __future__ import annotations
+
+import io
+import json
+from datetime import datetime, timezone
+
+import pytest
+
+import db
+import import_history
+
+
+BASE_UNIXTIME = 1704067200  # 2024-01-01T00:00:00Z
+CHAT_ID = -1000000000123
+
+
+@pytest.fixture
+def temp_db(tmp_path, monkeypatch):
+    monkeypatch.setattr(db, "DATABASE_PATH", str(tmp_path / "chat_logs.db"))
+    db.initialize_database()
+
+
+def make_message(msg_id: int, text, reply_to=None, **extra):
+    raw = {
+        "id": msg_id,
+        "type": "message",
+        "date": datetime.fromtimestamp(BASE_UNIXTIME + msg_id, tz=timezone.utc).replace(tzinfo=None).isoformat(),
+        "date_unixtime": str(BASE_UNIXTIME + msg_id),
+        "from": f"user{msg_id % 3}",
+        "from_id": f"user{msg_id % 3}",
+        "text": text,
+    }
+    if reply_to is not None:
+        raw["reply_to_message_id"] = reply_to
+    raw.update(extra)
+    return raw
+
+
+def write_export(path, messages, indent=1):
+    export = {"name": "Форум", "type": "private_supergroup", "id": 123, "messages": messages}
+    path.write_text(json.dumps(export, ensure_ascii=False, indent=indent), encoding="utf-8")
+    return str(path)
+
+
+def stored_rows():
+    with db.get_connection() as conn:
+        return [
+            tuple(r)
+            for r in conn.execute(
+                "SELECT chat_id, message_thread_id, user_name, message_text, timestamp FROM messages ORDER BY timestamp, id"
+            )
+        ]
+
+
+def index_names():
+    with db.get_connection() as conn:
+        return {r[1] for r in conn.execute("PRAGMA index_list(messages);")}
+
+
+TRICKY_MESSAGES = [
+    make_message(1, "Кириллица, эмодзи 😀 и иероглифы 漢字"),
+    make_message(2, 'Экранирование: \\ " \n \t \u0001 😀'),
+    make_message(3, ["Жирный ", {"type": "bold", "text": "текст"}, " и ", {"type": "link", "text": "ссылка"}]),
+    make_message(4, "", media_type="sticker", width=512, height=-1, ratio=1.5e10),
+    make_message(5, "большой id", reply_to=123456789012345, forwarded=True, edited=None, views=0.25),
+]
+
+
+@pytest.mark.parametrize("chunk_size", [1, 7, 13, 64, 4096])
+@pytest.mark.parametrize("indent", [None, 1])
+def test_reader_matches_json_load(tmp_path, monkeypatch, chunk_size, indent):
+    path = write_export(tmp_path / "result.json", TRICKY_MESSAGES, indent=indent)
+    monkeypatch.setattr(import_history, "CHUNK_SIZE", chunk_size)
+
+    with open(path, encoding="utf-8") as fp:
+        reader = import_history.ExportReader(fp)
+        header = dict(reader.header)
+        messages = list(reader)
+
+    with open(path, encoding="utf-8") as fp:
+        expected = json.load(fp)
+    assert messages == expected.pop("messages")
+    assert header == expected
+
+
+def test_reader_number_at_chunk_boundary(monkeypatch):
+    # Число 12345 обрезается на границе блока: без дочитывания получилось бы 12
+    monkeypatch.setattr(import_history, "CHUNK_SIZE", 2)
+    reader = import_history.ExportReader(io.StringIO('{"id":12345,"messages":[1234567,89]}'))
+    assert reader.header == {"id": 12345}
+    assert list(reader) == [1234567, 89]
+
+
+def test_reader_empty_messages_and_errors():
+    assert list(import_history.ExportReader(io.StringIO('{"id": 1, "messages": []}'))) == []
+    with pytest.raises(ValueError):
+        import_history.ExportReader(io.StringIO('{"chats": {"list": []}}'))
+    with pytest.raises(json.JSONDecodeError):
+        list(import_history.ExportReader(io.StringIO('{"messages": [{"id": 1}, {"id": ')))
+
+
+def test_reader_rejects_full_account_export_without_loading_it(monkeypatch):
+    monkeypatch.setattr(import_history, "CHUNK_SIZE", 64)
+    chats = [{"name": f"чат {i}", "messages": [make_message(j, "текст") for j in range(1, 50)]} for i in range(50)]
+    fp = io.StringIO(json.dumps({"about": "Экспорт аккаунта", "chats": {"list": chats}}, ensure_ascii=False))
+
+    with pytest.raises(ValueError, match="chats"):
+        import_history.ExportReader(fp)
+    # Упали на первом блоке, а не после разбора всего дерева chats
+    assert fp.tell() <= 64
+
+
+def test_import_maps_topics_through_reply_chains(temp_db, tmp_path):
+    messages = [
+        make_message(1, "Общий чат"),
+        make_message(2, "", type="service", action="topic_created", title="Поддержка"),
+        make_message(3, "Вопрос в теме", reply_to=2),
+        make_message(4, "Ответ на вопрос", reply_to=3),
+        make_message(5, "Ответ на ответ", reply_to=4),
+        make_message(6, "Ответ на сообщение общего чата", reply_to=1),
+        make_message(7, "", type="service", action="topic_created", title="Разработка"),
+        make_message(8, "Релиз", reply_to=7),
+    ]
+    path = write_export(tmp_path / "result.json", messages)
+
+    written, skipped = import_history.import_export(path)
+
+    assert (written, skipped) == (6, 2)
+    threads = {text: thread_id for _, thread_id, _, text, _ in stored_rows()}
+    assert threads == {
+        "Общий чат": None,
+        "Вопрос в теме": 2,
+        "Ответ на вопрос": 2,
+        "Ответ на ответ": 2,
+        "Ответ на сообщение общего чата": None,
+        "Релиз": 7,
+    }
+    assert {row[0] for row in stored_rows()} == {CHAT_ID}
+
+
+def test_interrupted_import_resumes(temp_db, tmp_path, monkeypatch):
+    messages = [make_message(1, "", type="service", action="topic_created", title="Тема")]
+    messages += [make_message(i, f"сообщение {i}", reply_to=1 if i % 2 else None) for i in range(2, 52)]
+    path = write_export(tmp_path / "result.json", messages)
+
+    add_batch = db.add_messages_batch
+    calls = []
+
+    def failing_add_batch(*args, **kwargs):
+        calls.append(args)
+        if len(calls) == 3:
+            raise RuntimeError("процесс убит")
+        add_batch(*args, **kwargs)
+
+    monkeypatch.setattr(db, "add_messages_batch", failing_add_batch)
+    with pytest.raises(RuntimeError):
+        import_history.import_export(path, batch_size=10)
+    monkeypatch.setattr(db, "add_messages_batch", add_batch)
+
+    assert len(stored_rows()) == 20
+    assert db.get_import_progress(CHAT_ID).last_message_id == 21
+    # Индексы перестраиваются и после сбоя
+    assert {"idx_messages_chat_time", "idx_messages_chat_thread_time"} <= index_names()
+
+    written, _ = import_history.import_export(path, batch_size=10)
+
+    assert written == 30
+    rows = stored_rows()
+    assert [text for _, _, _, text, _ in rows] == [f"сообщение {i}" for i in range(2, 52)]
+    # Карта тем восстанавливается по уже импортированной части экспорта
+    assert all(thread_id == (1 if text.endswith(("1", "3", "5", "7", "9")) else None) for _, thread_id, _, text, _ in rows)
+    assert db.get_import_progress(CHAT_ID).rows_imported == 50
+
+
+def test_newer_export_does_not_duplicate_live_messages(temp_db, tmp_path):
+    path = write_export(tmp_path / "old.json", [make_message(i, f"m{i}") for i in range(1, 11)])
+    assert import_history.import_export(path) == (10, 0)
+
+    # Бот тем временем сохранил m11 и m12 сам
+    for i in (11, 12):
+        db.add_message(CHAT_ID, "live", f"m{i}", datetime.fromtimestamp(BASE_UNIXTIME + i, tz=timezone.utc))
+
+    path = write_export(tmp_path / "new.json", [make_message(i, f"m{i}") for i in range(1, 15)])
+    written, skipped = import_history.import_export(path)
+
+    assert (written, skipped) == (0, 4)
+    assert [text for _, _, _, text, _ in stored_rows()] == [f"m{i}" for i in range(1, 13)]
+
+
+def test_incremental_import_keeps_indexes(temp_db, tmp_path, monkeypatch):
+    db.add_message(-100, "live", "другой чат", datetime.now(timezone.utc))
+
+    def fail_drop():
+        raise AssertionError("индексы не должны сниматься на непустой таблице")
+
+    monkeypatch.setattr(db, "drop_message_indexes", fail_drop)
+    path = write_export(tmp_path / "result.json", [make_message(1, "m1")])
+
+    assert import_history.import_export(path) == (1, 0)
+    assert {"idx_messages_chat_time", "idx_messages_chat_thread_time"} <= index_names()
@@ -0,0 +1,292 @@
+"""
+Тесты возобновляемых прогонов ежедневного саммари (bot.process_summary_run).
+"""
+
+from __future__ import annotations
+
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+import bot
+import db
+
+
+WINDOW_END = datetime(2024, 1, 2, 21, 0, tzinfo=timezone.utc)
+WINDOW_START = WINDOW_END - timedelta(days=1)
+
+
+class StubBot:
+    """Bot с send_message, который записывает отправки и может падать по заказу."""
+
+    def __init__(self, fail_times: int = 0, delay: float = 0.0) -> None:
+        self.sent = []
+        self.fail_times = fail_times
+        self.delay = delay
+
+    async def send_message(self, chat_id: int, text: str) -> None:
+        await asyncio.sleep(self.delay)
+        if self.fail_times:
+            self.fail_times -= 1
+            raise RuntimeError("Telegram недоступен")
+        self.sent.append((chat_id, text))
+
+
+class StubSummarizer:
+    def __init__(self, fail_on=(), reply=None) -> None:
+        self.calls = []
+        self.fail_on = set(fail_on)
+        self.fail_times = {}
+        self.reply = reply
+
+    def __call__(self, messages_text: str) -> str:
+        self.calls.append(messages_text)
+        if any(marker in messages_text for marker in self.fail_on):
+            raise RuntimeError("LLM недоступна")
+        for marker, left in self.fail_times.items():
+            if left and marker in messages_text:
+                self.fail_times[marker] -= 1
+                raise RuntimeError("LLM временно недоступна")
+        return self.reply if self.reply is not None else f"Саммари: {messages_text}"
+
+
+@pytest.fixture
+def temp_db(tmp_path, monkeypatch):
+    monkeypatch.setattr(db, "DATABASE_PATH", str(tmp_path / "chat_logs.db"))
+    monkeypatch.setattr(bot, "SUMMARY_RETRY_BASE_SECONDS", 0.0)
+    monkeypatch.setattr(bot, "SUMMARY_MAX_ATTEMPTS", 3)
+    db.initialize_database()
+
+
+@pytest.fixture
+def summarizer(monkeypatch):
+    stub = StubSummarizer()
+    monkeypatch.setattr(bot, "summarize_messages_text", stub)
+    return stub
+
+
+def add_window_message(chat_id: int, text: str, thread_id=None) -> None:
+    db.add_message(chat_id, "Алиса", text, WINDOW_END - timedelta(hours=1), message_thread_id=thread_id)
+
+
+def new_run() -> db.SummaryRun:
+    return db.get_or_create_summary_run(WINDOW_START, WINDOW_END)
+
+
+def items_by_key(run: db.SummaryRun):
+    return {(item.chat_id, item.message_thread_id): item for item in db.get_summary_run_items(run.id)}
+
+
+def test_window_is_aligned_to_schedule():
+    start, end = bot.current_summary_window(datetime(2024, 1, 3, 15, 30, tzinfo=timezone.utc))
+    assert (start, end) == (WINDOW_START, WINDOW_END)
+    assert bot.current_summary_window(WINDOW_END) == (WINDOW_START, WINDOW_END)
+
+
+def test_messages_outside_window_are_ignored(temp_db, summarizer):
+    add_window_message(1, "в окне")
+    db.add_message(1, "Боб", "после окна", WINDOW_END + timedelta(seconds=1))
+    stub = StubBot()
+
+    asyncio.run(bot.process_summary_run(stub, new_run()))
+
+    assert len(summarizer.calls) == 1
+    assert "в окне" in summarizer.calls[0] and "после окна" not in summarizer.calls[0]
+    assert [chat_id for chat_id, _ in stub.sent] == [1]
+
+
+def test_send_failure_is_retried_with_stored_summary(temp_db, summarizer):
+    add_window_message(1, "привет")
+    stub = StubBot(fail_times=1)
+    run = new_run()
+
+    asyncio.run(bot.process_summary_run(stub, run))
+
+    assert len(summarizer.calls) == 1
+    assert stub.sent == [(1, "Саммари: - Алиса: привет")]
+    item = items_by_key(run)[(1, None)]
+    assert (item.status, item.attempts, item.error) == ("sent", 0, None)
+    assert db.get_summary_run_chat_send_attempts(run.id, 1) == 1
+    assert db.get_unfinished_summary_runs() == []
+
+
+def test_flaky_thread_and_send_failure_resend_whole_chat(temp_db, summarizer):
+    summarizer.fail_times = {"капризная тема": 2}
+    add_window_message(1, "рабочая тема", thread_id=2)
+    add_window_message(1, "капризная тема", thread_id=5)
+    stub = StubBot(fail_times=1)
+    run = new_run()
+
+    asyncio.run(bot.process_summary_run(stub, run))
+
+    # Отправка повторена целиком: обе темы в одном сообщении, LLM по ним повторно не вызывалась
+    assert len(stub.sent) == 1
+    assert "Тема 2" in stub.sent[0][1] and "Тема 5" in stub.sent[0][1]
+    assert len(summarizer.calls) == 4
+    items = items_by_key(run)
+    assert (items[(1, 2)].status, items[(1, 5)].status) == ("sent", "sent")
+    assert (items[(1, 2)].attempts, items[(1, 5)].attempts) == (0, 2)
+    assert db.get_unfinished_summary_runs() == []
+
+
+def test_send_exhaustion_fails_chat_and_finishes_run(temp_db, summarizer):
+    add_window_message(1, "рабочая тема", thread_id=2)
+    add_window_message(1, "вторая тема", thread_id=5)
+    stub = StubBot(fail_times=100)
+    run = new_run()
+
+    asyncio.run(bot.process_summary_run(stub, run))
+
+    assert stub.sent == []
+    assert len(summarizer.calls) == 2
+    assert db.get_summary_run_chat_send_attempts(run.id, 1) == 3
+    for item in items_by_key(run).values():
+        assert item.status == "failed" and item.summary and item.error.startswith("send: ")
+    # Исчерпавшие попытки элементы не держат прогон открытым
+    assert db.get_unfinished_summary_runs() == []
+
+
+def test_failing_thread_is_dropped_after_last_attempt(temp_db, summarizer):
+    summarizer.fail_on = {"сломанная тема"}
+    add_window_message(1, "рабочая тема", thread_id=2)
+    add_window_message(1, "сломанная тема", thread_id=5)
+    stub = StubBot()
+    run = new_run()
+
+    asyncio.run(bot.process_summary_run(stub, run))
+
+    # Чат ждал повторов упавшей темы и ушёл одним сообщением без неё
+    assert len(stub.sent) == 1
+    assert "Тема 2" in stub.sent[0][1] and "Тема 5" not in stub.sent[0][1]
+    items = items_by_key(run)
+    assert items[(1, 2)].status == "sent"
+    failed = items[(1, 5)]
+    assert (failed.status, failed.attempts) == ("failed", 3)
+    assert failed.error.startswith("summarize: ")
+    # Причина сохранена в элементе, а прогон закрыт: повторять больше нечего
+    assert db.get_unfinished_summary_runs() == []
+
+
+def test_attempt_limit_holds_across_restarts(temp_db, summarizer):
+    summarizer.fail_on = {"сломанная тема"}
+    add_window_message(1, "сломанная тема")
+    run = new_run()
+    asyncio.run(bot.process_summary_run(StubBot(), run))
+    calls = len(summarizer.calls)
+
+    # Перезапуски не дают исчерпанному элементу новых попыток
+    asyncio.run(bot.resume_unfinished_summary_runs(StubBot()))
+    asyncio.run(bot.process_summary_run(StubBot(), run))
+
+    assert calls == 3
+    assert len(summarizer.calls) == calls
+
+
+def test_restart_retries_failed_items(temp_db, summarizer, monkeypatch):
+    summarizer.fail_on = {"привет"}
+    add_window_message(1, "привет")
+    run = new_run()
+
+    class Crash(Exception):
+        pass
+
+    async def crash(_delay):
+        raise Crash()
+
+    # Процесс падает, пока ждёт повтора
+    with monkeypatch.context() as m:
+        m.setattr(bot.asyncio, "sleep", crash)
+        with pytest.raises(Crash):
+            asyncio.run(bot.process_summary_run(StubBot(), run))
+
+    summarizer.fail_on = set()
+    stub = StubBot()
+    asyncio.run(bot.resume_unfinished_summary_runs(stub))
+
+    assert len(stub.sent) == 1
+    assert items_by_key(run)[(1, None)].status == "sent"
+    assert db.get_unfinished_summary_runs() == []
+
+
+def test_resume_after_crash_between_summarize_and_send(temp_db, summarizer, monkeypatch):
+    add_window_message(1, "привет")
+    run = new_run()
+    db.ensure_summary_run_item(run.id, 1, None)
+    # Упавший процесс успел захватить чат и сохранить саммари, но не отправить его
+    (item,) = db.claim_summary_run_chat(run.id, 1, 3, timedelta(minutes=10))
+    db.update_summary_run_item(item.id, "in_progress", summary="Сохранённое саммари")
+
+    # Свежий захват чужого процесса не перехватывается
+    stub = StubBot()
+    asyncio.run(bot.resume_unfinished_summary_runs(stub))
+    assert stub.sent == []
+
+    # Просроченный — перехватывается, LLM повторно не вызывается
+    monkeypatch.setattr(bot, "SUMMARY_CLAIM_TIMEOUT_SECONDS", 0.0)
+    asyncio.run(bot.resume_unfinished_summary_runs(stub))
+
+    assert summarizer.calls == []
+    assert stub.sent == [(1, "Сохранённое саммари")]
+    assert db.get_unfinished_summary_runs() == []
+
+
+def test_lost_claim_is_not_sent(temp_db, summarizer, monkeypatch):
+    add_window_message(1, "привет")
+    run = new_run()
+    stub = StubBot()
+
+    def slow_summary(messages_text: str) -> str:
+        # Пока LLM думала, захват просрочился и его забрал другой процесс
+        db.claim_summary_run_chat(run.id, 1, 3, timedelta(0))
+        return "Саммари"
+
+    monkeypatch.setattr(bot, "summarize_messages_text", slow_summary)
+    asyncio.run(bot.process_summary_run(stub, run))
+
+    assert stub.sent == []
+    assert items_by_key(run)[(1, None)].status == "in_progress"
+
+
+def test_startup_creates_missed_run(temp_db, summarizer, monkeypatch):
+    # Бот был выключен в 21:00: строки прогона за окно нет
+    monkeypatch.setattr(bot, "current_summary_window", lambda: (WINDOW_START, WINDOW_END))
+    add_window_message(1, "привет")
+    stub = StubBot()
+
+    asyncio.run(bot.resume_unfinished_summary_runs(stub))
+
+    assert [chat_id for chat_id, _ in stub.sent] == [1]
+    assert db.get_unfinished_summary_runs() == []
+
+
+def test_empty_summary_is_skipped(temp_db, summarizer):
+    summarizer.reply = ""
+    add_window_message(1, "привет")
+    stub = StubBot()
+    run = new_run()
+
+    asyncio.run(bot.process_summary_run(stub, run))
+
+    assert stub.sent == []
+    item = items_by_key(run)[(1, None)]
+    assert (item.status, item.summary) == ("skipped", None)
+    assert db.get_unfinished_summary_runs() == []
+
+
+def test_concurrent_runs_do_not_double_post(temp_db, summarizer):
+    for chat_id in (1, 2, 3):
+        add_window_message(chat_id, f"чат {chat_id}")
+    stub = StubBot(delay=0.05)
+
+    async def two_processes() -> None:
+        # Бот по расписанию и ручной run_summary_send.py над одним прогоном
+        await asyncio.gather(
+            bot.process_summary_run(stub, new_run()),
+            bot.resume_unfinished_summary_runs(stub),
+        )
+
+    asyncio.run(two_processes())
+
+    assert sorted(chat_id for chat_id, _ in stub.sent) == [1, 2, 3]
+    assert len(summarizer.calls) == 3